@@ -5,14 +5,64 @@ import numpy as np
 
 from matplotlib import pyplot as plt
 from mne import set_log_level
+from scipy import signal
 
 from mne_lsl.datasets import sample
-from mne_lsl.stream import StreamLSL 
+from pylsl import (StreamInlet, cf_double64, cf_float32, cf_int8, cf_int16,
+                   cf_int32, cf_int64, resolve_byprop)
 
 from mne_lsl.player import PlayerLSL as Player
 
+try:
+    from numba import njit, prange
+except ImportError:  # run the kernel as plain Python if numba is missing
+    prange = range
+
+    def njit(*args, **kwargs):
+        return lambda f: f
+
 set_log_level("WARNING")
 
+
+@njit(parallel=True, fastmath=True, cache=True)
+def detect_blinks(x, baseline, std, k):
+    """Blink mask |x - baseline| > k*std for x of shape (n_ch, n_samples), in one fused loop."""
+    out = np.empty(x.shape, np.bool_)
+    thr = k * std
+    for i in prange(x.shape[0]):
+        for j in range(x.shape[1]):
+            out[i, j] = abs(x[i, j] - baseline) > thr
+    return out
+
+
+def filter_new_samples(sos, data, n_new, zi, out):
+    """
+    Band-pass only the n_new most recent samples of the window `data`,
+    continuing the filter state zi, and shift them into the filtered window
+    `out` (same shape as data). Returns the updated state.
+    """
+    n_new = min(n_new, out.shape[-1])
+    if n_new == 0:
+        return zi
+    x = data[:, -n_new:]
+    if zi is None:
+        # start in steady state for the first sample to avoid a step transient
+        zi = signal.sosfilt_zi(sos)[:, np.newaxis, :] * x[np.newaxis, :, :1]
+    y, zi = signal.sosfilt(sos, x, axis=-1, zi=zi)
+    out[:, :-n_new] = out[:, n_new:]
+    out[:, -n_new:] = y
+    return zi
+
+
+def channel_labels(info):
+    """Channel labels from an LSL StreamInfo's desc/channels."""
+    labels = []
+    ch = info.desc().child("channels").child("channel")
+    for _ in range(info.channel_count()):
+        labels.append(ch.child_value("label"))
+        ch = ch.next_sibling()
+    return labels
+
 # %% CONNECT TO STREAM - starting from here, it is the same as in the real EEG acquisition!
 
 
@@ -21,7 +71,9 @@ fname = sample.data_path() / "sample-ant-raw.fif"
 player = Player(fname, chunk_size=200, source_id=source_id).start()
 fs = player.info["sfreq"]
 interval = player.chunk_size / fs  # in seconds
-stream = StreamLSL(bufsize=2, source_id=source_id).connect()
+# raw LSL inlet; channel picking and filtering are done here, not in mne_lsl
+inlet = StreamInlet(resolve_byprop("source_id", source_id, timeout=10)[0])
+inlet.open_stream()
 # # Based on rt_topomap.py
 # check inputs
 # check_type(stream_name, (str,), "stream_name")
@@ -36,12 +88,13 @@ duration = 30
 stream_name = "Gwennie-24"
 
 #%%
-#stream = StreamLSL(bufsize=winsize, name=stream_name).connect()
-#stream.drop_channels(("TRG", "X1", "X2", "X3", "A2"))
-stream.pick("Fp1")
-stream.set_montage("standard_1020")
-stream.filter(2, 25)
-# stream.info
+#inlet = StreamInlet(resolve_byprop("name", stream_name, timeout=10)[0])
+lsl_info = inlet.info()
+picks = ["Fp1"]
+pick_idx = [channel_labels(lsl_info).index(p) for p in picks]
+# 2-25 Hz band-pass designed once; state is kept across pulled chunks
+SOS = signal.butter(4, [2, 25], btype="band", fs=fs, output="sos")
+zi = None
 
 #%%
 
@@ -54,28 +107,67 @@ time.sleep(winsize)
 # main loop
 start = time.time()
 
-calibration_points, calibration_times = [], []
-
-
-while time.time() - start < duration:
-    data, _ = stream.get_data(winsize)
-    calibration_points.append(data)
-
-calibration_points = np.array(calibration_points)
-baseline_FP1 = np.mean(calibration_points.ravel())
-std_FP1 = np.std(calibration_points)
+# preallocate the calibration buffer: one window per chunk interval (+ margin)
+n_ch = len(picks)
+n_samples = int(winsize * fs)
+n_blocks = int(np.ceil(duration / interval)) + 8
+buf = np.empty((n_blocks, n_ch, n_samples), dtype=np.float32)
+i = 0
+
+# filtered copy of the current window, updated with new samples only
+filtered = np.zeros((n_ch, n_samples))
+
+# pull_chunk writes into this buffer (all stream channels) instead of allocating;
+# it is filled with the stream's native type, so the dtype must match it
+LSL_DTYPES = {cf_float32: np.float32, cf_double64: np.float64,
+              cf_int8: np.int8, cf_int16: np.int16,
+              cf_int32: np.int32, cf_int64: np.int64}
+if lsl_info.channel_format() not in LSL_DTYPES:
+    raise RuntimeError(
+        f"Unsupported LSL channel format {lsl_info.channel_format()} "
+        "(numeric streams only)"
+    )
+dtype = LSL_DTYPES[lsl_info.channel_format()]
+chunk = np.empty((n_samples, lsl_info.channel_count()), dtype=dtype)
+
+while time.time() - start < duration and i < n_blocks:
+    _, ts = inlet.pull_chunk(timeout=0.0, max_samples=n_samples, dest_obj=chunk)
+    n_new = len(ts)
+    zi = filter_new_samples(SOS, chunk[:n_new, pick_idx].T, n_new, zi, filtered)
+    buf[i] = filtered
+    i += 1
+    time.sleep(interval)
+
+calibration_points = buf[:i]
+baseline_FP1 = calibration_points.mean(dtype=np.float64)
+std_FP1 = calibration_points.std(dtype=np.float64)
 
 print(baseline_FP1)
 
 datapoints, times = [], []
 
-while stream.n_new_samples < stream.n_buffer:
-    time.sleep(0.1)
+threshold = 4*std_FP1
+
+# figure with static threshold lines; only the two traces are redrawn (blitting)
+fig, ax = plt.subplots()
+line_data, = ax.plot(np.zeros(n_samples), animated=True)
+line_blink, = ax.plot(np.zeros(n_samples), color="black", animated=True)
+ax.hlines([baseline_FP1, baseline_FP1+threshold, baseline_FP1-threshold],
+          0, n_samples, colors="red")
+ax.set_xlim(0, n_samples)
+ax.set_ylim(baseline_FP1-2*threshold, baseline_FP1+2*threshold)
+fig.canvas.draw()
+bg = fig.canvas.copy_from_bbox(ax.bbox)
 
 while len(datapoints) != 30:
-    if stream.n_new_samples == 0:
+    _, ts = inlet.pull_chunk(timeout=0.0, max_samples=n_samples, dest_obj=chunk)
+    n_new = len(ts)
+    if n_new == 0:
+        # wait for the next chunk instead of spinning on a full core
+        time.sleep(interval/4)
         continue
-    data, _ = stream.get_data(winsize)
+    zi = filter_new_samples(SOS, chunk[:n_new, pick_idx].T, n_new, zi, filtered)
+    data = filtered.copy()
 
     datapoints.append(data)
 
@@ -85,21 +177,21 @@ while len(datapoints) != 30:
     # print(metric)
     time.sleep(0.2)
 
-    plt.plot(np.array(data).ravel())
-    plt.hlines(baseline_FP1,0,900,colors="red")
-    plt.hlines(baseline_FP1+4*std_FP1,0,900,colors="red")
-
-    blinking = np.abs(data-baseline_FP1) > 4*std_FP1
+    blinking = detect_blinks(data, baseline_FP1, std_FP1, 4.0)
 
-    plt.hlines(baseline_FP1-4*std_FP1,0,900,colors="red")
-    plt.plot(blinking*(baseline_FP1+4*std_FP1), color="black")
-    plt.show(block=True)
+    line_data.set_ydata(data.reshape(-1))
+    line_blink.set_ydata(blinking.reshape(-1)*(baseline_FP1+threshold))
+    fig.canvas.restore_region(bg)
+    ax.draw_artist(line_data)
+    ax.draw_artist(line_blink)
+    fig.canvas.blit(ax.bbox)
+    fig.canvas.flush_events()
 
 
 time.sleep(20)
 plt.ioff()
 plt.close()
 
-stream.disconnect()
+inlet.close_stream()
 
 # how to adapt this to real time, next timepoints 
\ No newline at end of file
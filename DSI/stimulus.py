@@ -2,20 +2,28 @@
 
 from psychopy import core, visual, event
 from pylsl import StreamInfo, StreamOutlet
+import array
 import random
 
 def main():
     info = StreamInfo(name='stimulus_stream', type='Markers', channel_count=1,
                       channel_format='int32', source_id='stimulus_stream_001')
     outlet = StreamOutlet(info)  # Broadcast the stream.
-    
+
+    # one-sample int32 buffer reused for every marker push
+    sample_buf = array.array('i', [0])
+
+    def push_marker(code):
+        sample_buf[0] = code
+        outlet.push_sample(sample_buf)
+
     markers = {
-        'test': [99],
-        'start': [88],
-        'baseline' : [77],
-        'movement1' : [1],
-        'movement2' : [2],
-        'movement3' : [3],
+        'test': 99,
+        'start': 88,
+        'baseline' : 77,
+        'movement1' : 1,
+        'movement2' : 2,
+        'movement3' : 3,
     }
 
     win = visual.Window([1000, 800], allowGUI=False, monitor='testMonitor', # [1000, 800]
@@ -34,6 +42,7 @@ def main():
     mov_done = visual.TextStim(win, text="Relax. \n\n If ready for the next movement, please press <SPACE>")
 
     countdown = visual.TextStim(win, text="3", color="white", height=3.0)
+    hint = visual.TextStim(win, color="white")
     def cd_stim():
         for t in range(3, 0, -1):  # Countdown from 3 to 1
             countdown.text = str(f'{t}')
@@ -45,7 +54,6 @@ def main():
         
     def mov_stim(movi, mov_n):
         # show which movement is coming up
-        hint = visual.TextStim(win, color="white")
         hint.text = f'Next movement is: \n\n     {movi.text} \n\n Are you ready? Press <SPACE>'
         hint.draw()
         win.flip()
@@ -54,10 +62,10 @@ def main():
         # start countdown
         cd_stim()
         
-        # send marker for performed movement
+        # send marker for performed movement, right when the stimulus appears
         movi.draw()
+        win.callOnFlip(push_marker, mov_n)
         win.flip()
-        outlet.push_sample(mov_n)
         core.wait(2)
         win.flip()
         core.wait(2)
@@ -76,13 +84,13 @@ def main():
 
     # Send triggers to test communication
     for _ in range(5):
-        outlet.push_sample(markers['test'])
+        push_marker(markers['test'])
         core.wait(0.5)
 
     # Start the recording
     start = visual.TextStim(win, text="To start the recording, hit the record button on labrecorder and press <SPACE>")
     start.draw()
-    outlet.push_sample( markers['start'])
+    push_marker(markers['start'])
     win.flip()
     key_resp()
     
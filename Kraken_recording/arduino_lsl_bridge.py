@@ -8,9 +8,13 @@ LSL bridge for Upside Down Labs UNO R4 EMG firmware (6 channels, 500 Hz).
 import os
 os.environ["LSL_NO_NETWORK"] = "1"  # keep LSL local (no multicast)
 
+import queue
+import struct
+import threading
 import time
+import numpy as np
 import serial
-from pylsl import StreamInfo, StreamOutlet
+from pylsl import StreamInfo, StreamOutlet, local_clock
 
 # ---------- CONFIGURE THIS ----------
 PORT = "COM12"           # <-- COM port of the Arduino on COMPUTER B
@@ -21,36 +25,116 @@ SAMPLE_RATE = 500.0      # Hz, from SAMP_RATE in Arduino code
 SYNC_BYTE_1 = 0xC7
 SYNC_BYTE_2 = 0x7C
 END_BYTE    = 0x01
+SYNC_WORD   = bytes([SYNC_BYTE_1, SYNC_BYTE_2])
 PACKET_LEN  = NUM_CHANNELS * 2 + 3 + 1   # 6*2 + 3 header + 1 end = 16
+BATCH       = 25                         # samples per push_chunk (50 ms @ 500 Hz)
+NUM_BUFFERS = 16                         # preallocated batch buffers shared by the threads
+MAX_LAG     = 0.1                        # s behind local_clock() before timestamps jump forward
+SLEW        = 0.1                        # fraction of the clock error corrected per batch
 # ------------------------------------
 
+# Largest per-batch timestamp correction; below one sample period, so slewing
+# never makes a batch start before the previous batch's last sample
+MAX_SLEW = 0.5 / SAMPLE_RATE
+
+# Per-sample timestamp offsets within a batch, relative to its first sample
+BATCH_OFFSETS = np.arange(BATCH) / SAMPLE_RATE
+
+# Decodes the channel values (big-endian uint16) of one packet in a single call
+_UNPACK = struct.Struct(f">{NUM_CHANNELS}H").unpack_from
 
-def read_exact(ser, n):
-    """Read exactly n bytes from serial (blocking until all are read)."""
-    data = bytearray()
-    while len(data) < n:
-        chunk = ser.read(n - len(data))
-        if not chunk:
-            continue
-        data.extend(chunk)
-    return bytes(data)
 
+def scan_packets(buf):
+    """
+    Locate complete C7 7C ... 01 packets in buf.
 
-def find_sync(ser):
-    """Align to the C7 7C sync sequence, return a full 16-byte packet."""
+    Returns (offsets, consumed): the start offset of every valid packet,
+    and how many leading bytes of buf can be dropped. A trailing partial
+    packet is kept so it can be completed by the next read.
+    """
+    offsets = []
+    pos = 0
     while True:
-        b = ser.read(1)
-        if not b:
-            continue
-        if b[0] != SYNC_BYTE_1:
-            continue
-        b2 = ser.read(1)
-        if not b2 or b2[0] != SYNC_BYTE_2:
-            # restart search
+        i = buf.find(SYNC_WORD, pos)
+        if i < 0:
+            # keep a trailing 0xC7 in case the sync word is split across reads
+            return offsets, max(pos, len(buf) - 1)
+        if i + PACKET_LEN > len(buf):
+            return offsets, i
+        if buf[i + PACKET_LEN - 1] != END_BYTE:
+            # false sync inside a payload (or lost sync); search again
+            pos = i + 1
             continue
-        # We have sync bytes, read the remaining bytes
-        rest = read_exact(ser, PACKET_LEN - 2)
-        return bytes([SYNC_BYTE_1, SYNC_BYTE_2]) + rest
+        offsets.append(i)
+        pos = i + PACKET_LEN
+
+
+def new_batch_buffer():
+    """Allocate one (BATCH, NUM_CHANNELS) float32 sample buffer."""
+    return np.empty((BATCH, NUM_CHANNELS), dtype=np.float32)
+
+
+def reader(ser, ready, free):
+    """
+    Serial reader thread: read in bulk, parse packets and hand every full
+    batch to the main thread as (base_ts, samples) through `ready`.
+
+    Batch buffers are taken from `free` and given back by the consumer once
+    pushed, so no arrays are allocated in steady state. Puts None on `ready`
+    if the serial port fails.
+
+    Samples are stamped from a running count at SAMPLE_RATE, anchored to
+    local_clock() at the first packet, so batches parsed from the same bulk
+    read never overlap. On every batch the anchor is slewed a little toward
+    local_clock() (either direction, at most MAX_SLEW), which absorbs a board
+    running off its nominal rate. If the stamps fall more than MAX_LAG behind
+    the clock (packets lost, reader stalled) they jump forward to it.
+    """
+    chunk_buf = new_batch_buffer()
+    idx = 0
+    base_ts = 0.0
+    t_anchor = None
+    n_total = 0  # samples stamped since t_anchor
+
+    # Raw serial bytes not yet parsed into packets
+    buf = bytearray()
+
+    try:
+        while True:
+            # Read everything that is waiting (at least one packet's worth)
+            buf += ser.read(max(ser.in_waiting, PACKET_LEN))
+
+            offsets, consumed = scan_packets(buf)
+            for off in offsets:
+                # Parse 6 channel values (big-endian uint16, 0..16383 with 14-bit ADC),
+                # skipping sync and counter
+                if idx == 0:
+                    now = local_clock()
+                    if t_anchor is None:
+                        t_anchor = now
+                    err = now - (t_anchor + n_total / SAMPLE_RATE)
+                    if err > MAX_LAG:
+                        t_anchor += err
+                    else:
+                        t_anchor += max(-MAX_SLEW, min(MAX_SLEW, SLEW * err))
+                    base_ts = t_anchor + n_total / SAMPLE_RATE
+                chunk_buf[idx] = _UNPACK(buf, off + 3)
+                idx += 1
+
+                if idx == BATCH:
+                    n_total += BATCH
+                    ready.put_nowait((base_ts, chunk_buf))
+                    try:
+                        chunk_buf = free.get_nowait()
+                    except queue.Empty:
+                        # consumer is lagging; grow the pool rather than block
+                        chunk_buf = new_batch_buffer()
+                    idx = 0
+
+            del buf[:consumed]
+    except serial.SerialException as e:
+        print(f"❌ Serial error: {e}")
+        ready.put(None)
 
 
 def main():
@@ -84,35 +168,34 @@ def main():
     outlet = StreamOutlet(info)
     print("✅ LSL stream 'EMG_Stream' (6 ch, 500 Hz) created.")
 
-    # ---- Align to first packet ----
-    packet = find_sync(ser)
-    print("Sync found, starting main loop...")
+    # ---- Start serial reader thread ----
+    ready = queue.Queue()
+    free = queue.Queue()
+    for _ in range(NUM_BUFFERS - 1):
+        free.put(new_batch_buffer())
+
+    reader_thread = threading.Thread(target=reader, args=(ser, ready, free),
+                                     daemon=True)
+    reader_thread.start()
+    print("Reader thread started, starting main loop...")
 
     sample_count = 0
     last_report = time.time()
 
     while True:
-        # After first packet, just read fixed-size chunks
-        packet = read_exact(ser, PACKET_LEN)
-
-        # Basic sanity checks
-        if packet[0] != SYNC_BYTE_1 or packet[1] != SYNC_BYTE_2 or packet[-1] != END_BYTE:
-            # Lost sync; realign
-            packet = find_sync(ser)
+        # Timeout keeps Ctrl+C responsive while waiting for data
+        try:
+            batch = ready.get(timeout=1.0)
+        except queue.Empty:
             continue
-
-        # Parse 6 channel values (uint16)
-        values = []
-        offset = 3  # skip sync and counter
-        for _ in range(NUM_CHANNELS):
-            high = packet[offset]
-            low  = packet[offset + 1]
-            raw  = (high << 8) | low        # 0..16383 with 14-bit ADC
-            values.append(float(raw))
-            offset += 2
-
-        outlet.push_sample(values)
-        sample_count += 1
+        if batch is None:
+            print("Serial reader stopped, exiting.")
+            break
+
+        base_ts, chunk_buf = batch
+        outlet.push_chunk(chunk_buf, (base_ts + BATCH_OFFSETS).tolist())
+        free.put(chunk_buf)
+        sample_count += BATCH
 
         # Print small status every second
         now = time.time()
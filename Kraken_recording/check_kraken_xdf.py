@@ -44,9 +44,12 @@ Quick checker for Kraken EMG XDF + PsychoPy log.
 Change XDF_PATH and STIM_LOG_PATH below.
 """
 
+import argparse
 import os
+import tempfile
 import numpy as np
 import matplotlib.pyplot as plt
+from matplotlib.collections import LineCollection
 import pyxdf
 import pandas as pd
 
@@ -61,11 +64,34 @@ XDF_PATH = r"/Users/elodiedong/Desktop/kraken_data/s013/sub-P005_ses-S013_task-D
 STIM_LOG_PATH = r"/Users/elodiedong/Desktop/kraken_data/s013/stim_log_20251129_153026"
 # STIM_LOG_PATH = None
 
+# Only decode streams of these types (falls back to all streams if the
+# EMG / marker stream is not among them)
+LOAD_STREAM_TYPES = [{"type": "EMG"}, {"type": "Markers"}]
+
+# EMG recordings bigger than this (MB, as float32) are moved to a temporary
+# on-disk .npy memmap so plots page samples in on demand; None = keep in RAM
+EMG_MEMMAP_MIN_MB = 256
+
 
 # ============
 #  HELPERS
 # ============
 
+def load_streams(sync, select_streams=None):
+    """
+    Load streams from XDF_PATH, optionally only those matching select_streams.
+    Clock sync + dejitter only run when sync is True.
+    """
+    streams, _ = pyxdf.load_xdf(
+        XDF_PATH,
+        select_streams=select_streams,
+        synchronize_clocks=sync,
+        dejitter_timestamps=sync,
+        handle_clock_resets=sync,
+    )
+    return streams
+
+
 def find_stream_by_name(streams, name_part):
     """Return first stream whose *name* contains name_part (case-insensitive), or None."""
     name_part = name_part.lower()
@@ -76,6 +102,13 @@ def find_stream_by_name(streams, name_part):
     return None
 
 
+def find_emg_stream(streams):
+    """Return the EMG stream (name containing 'emg', 'kraken' or 'muscle'), or None."""
+    return (find_stream_by_name(streams, "emg")
+            or find_stream_by_name(streams, "kraken")
+            or find_stream_by_name(streams, "muscle"))
+
+
 def guess_marker_stream(streams):
     """Try to guess a marker/event stream based on name or type."""
     for s in streams:
@@ -88,18 +121,83 @@ def guess_marker_stream(streams):
     return None
 
 
+def emg_to_channel_major(src, path=None):
+    """
+    Copy src (N, n_channels) into a float32 (n_channels, N) array, one channel
+    at a time. If path is given, the copy is an on-disk .npy memmap.
+    """
+    shape = (src.shape[1], src.shape[0])
+    if path is None:
+        out = np.empty(shape, dtype=np.float32)
+    else:
+        out = np.lib.format.open_memmap(path, mode="w+", dtype=np.float32, shape=shape)
+    for ch in range(shape[0]):
+        out[ch] = src[:, ch]
+    return out
+
+
+def downsample_for_plot(t, y, target=5000):
+    """
+    Reduce (t, y) to about `target` points for plotting.
+
+    Samples are split into target/2 buckets and the min and max of each bucket
+    are kept (in time order), so EMG bursts keep their peaks. Only the plotted
+    copy is reduced; the raw arrays are left unmodified.
+    """
+    n_buckets = target // 2
+    stride = len(y) // n_buckets if n_buckets > 0 else 0
+    if stride < 2:
+        return t, y
+
+    n = stride * n_buckets
+    buckets = y[:n].reshape(n_buckets, stride)
+    lo = buckets.argmin(axis=1)
+    hi = buckets.argmax(axis=1)
+    starts = np.arange(n_buckets) * stride
+    idx = np.stack([starts + np.minimum(lo, hi),
+                    starts + np.maximum(lo, hi)], axis=1).reshape(-1)
+    idx = np.concatenate([idx, np.arange(n, len(y))])  # leftover tail samples
+    return t[idx], y[idx]
+
+
+def add_marker_lines(ax, xs, alpha):
+    """
+    Draw a full-height vertical line at each x in xs (like axvline), as a
+    single LineCollection instead of one artist per marker.
+    """
+    segs = np.empty((len(xs), 2, 2))
+    segs[:, :, 0] = xs[:, np.newaxis]
+    segs[:, 0, 1] = 0.0  # bottom of axes
+    segs[:, 1, 1] = 1.0  # top of axes
+    ax.add_collection(
+        LineCollection(segs, transform=ax.get_xaxis_transform(), alpha=alpha),
+        autolim=False,
+    )
+
+
 # ============
 #  MAIN
 # ============
 
-def main():
+def main(sync=False):
     # --- Load XDF file ---
     if not os.path.exists(XDF_PATH):
         print(f"❌ XDF file not found:\n{XDF_PATH}")
         return
 
     print(f"📂 Loading XDF: {XDF_PATH}")
-    streams, file_header = pyxdf.load_xdf(XDF_PATH)
+    # Clock sync + dejitter are skipped unless --sync is given: this is only a
+    # quick look at raw samples. Without them, timestamps (and the sampling
+    # rate derived from np.diff(emg_ts) below) are the raw device timestamps.
+    try:
+        streams = load_streams(sync, LOAD_STREAM_TYPES)
+    except ValueError:  # pyxdf raises if no stream matches the selection
+        streams = []
+    if find_emg_stream(streams) is None:
+        # the name-based EMG guess may match a stream of another type; a
+        # missing marker stream is fine (EMG-only recordings), no reload
+        print("   EMG stream not found by type, loading all streams...")
+        streams = load_streams(sync)
 
     print("\n=== Streams found in file ===")
     for i, s in enumerate(streams):
@@ -109,9 +207,7 @@ def main():
         print(f"{i}: name='{name}', type='{stype}', channels={n_ch}")
 
     # --- Find EMG stream ---
-    emg_stream = (find_stream_by_name(streams, "emg")
-                  or find_stream_by_name(streams, "kraken")
-                  or find_stream_by_name(streams, "muscle"))
+    emg_stream = find_emg_stream(streams)
 
     if emg_stream is None:
         print("\n❌ Could not find EMG stream (name containing 'EMG' or 'Kraken').")
@@ -127,157 +223,192 @@ def main():
         print("⚠ No obvious marker stream found. We'll just inspect EMG.")
 
     # --- Extract EMG data ---
+    # Keep timestamps as returned (float64)
     emg_ts = np.asarray(emg_stream["time_stamps"])
-    emg_data = np.asarray(emg_stream["time_series"]).astype(float)
+    src = np.asarray(emg_stream["time_series"])
 
     print("\n=== Raw EMG arrays ===")
-    print("emg_data shape:", emg_data.shape)
+    print("emg_data shape:", src.shape)
     print("emg_ts shape  :", emg_ts.shape)
 
     # Handle different channel layouts
-    if emg_data.ndim == 1:
-        emg_data = emg_data[:, np.newaxis]  # make (N,) -> (N,1)
-
-    # Pick channel 1 for quick 1D view
-    emg_data_1 = emg_data[:, 0]
-
-    # Safety check: not enough samples
-    if emg_data_1.size < 2 or emg_ts.size < 2:
-        print("\n=== EMG basic info ===")
-        print(f"Samples: {emg_data_1.size}")
-        print("⚠ Not enough samples to compute duration or sampling rate.")
-        print("   → The recording likely stopped very quickly or the stream died.")
-    else:
-        dt = np.diff(emg_ts)
-        good = np.isfinite(dt) & (dt > 0)
-        if good.sum() == 0:
-            fs = float("nan")
+    if src.ndim == 1:
+        src = src[:, np.newaxis]  # make (N,) -> (N,1)
+
+    # Large recordings go to a temporary memmap instead of staying in RAM
+    emg_tmp_path = None
+    if EMG_MEMMAP_MIN_MB is not None and src.size * 4 > EMG_MEMMAP_MIN_MB * 2**20:
+        fd, emg_tmp_path = tempfile.mkstemp(suffix=".npy")
+        os.close(fd)
+        print(f"💾 Large recording: EMG samples memory-mapped to {emg_tmp_path}")
+
+    # Everything from here may fail (plots, CSV, Ctrl-C): the temporary
+    # memmap is removed in the finally block either way
+    emg_data = emg_data_1 = None
+    try:
+        # Store channel-major (n_channels, N) float32 (as produced by the LSL
+        # outlet) so each channel is contiguous: per-channel plotting/decimation
+        # below reads with unit stride
+        emg_data = emg_to_channel_major(src, emg_tmp_path)
+
+        # Drop pyxdf's in-RAM copy; only emg_data is used from here on
+        del src
+        emg_stream["time_series"] = None
+
+        # Pick channel 1 for quick 1D view
+        emg_data_1 = emg_data[0]
+
+        # Safety check: not enough samples
+        if emg_data_1.size < 2 or emg_ts.size < 2:
+            print("\n=== EMG basic info ===")
+            print(f"Samples: {emg_data_1.size}")
+            print("⚠ Not enough samples to compute duration or sampling rate.")
+            print("   → The recording likely stopped very quickly or the stream died.")
+        else:
+            dt = np.diff(emg_ts)
+            good = np.isfinite(dt) & (dt > 0)
+            if good.sum() == 0:
+                fs = float("nan")
+            else:
+                fs = 1.0 / np.median(dt[good])
+
+            print("\n=== EMG basic info ===")
+            print(f"Samples: {emg_data_1.size}")
+            print(f"Duration: {emg_ts[-1] - emg_ts[0]:.2f} s")
+            print(f"Approx. sampling rate: {fs:.1f} Hz")
+            print(f"Amplitude range: [{emg_data_1.min():.3f}, {emg_data_1.max():.3f}]")
+            print(f"Any NaNs? {np.isnan(emg_data_1).any()}")
+
+        # --- Marker info ---
+        if marker_stream is not None:
+            m_ts = np.asarray(marker_stream["time_stamps"])
+            m_data = np.asarray(marker_stream["time_series"])
+            markers_flat = m_data[:, 0] if m_data.ndim == 2 else m_data  # usually 2D
+
+            print("\n=== Marker basic info ===")
+            print(f"Number of markers: {len(markers_flat)}")
+            uniq = np.unique(markers_flat)
+            print(f"Unique marker values (up to 20): {uniq[:20].tolist()}")
         else:
-            fs = 1.0 / np.median(dt[good])
+            m_ts = None
 
-        print("\n=== EMG basic info ===")
-        print(f"Samples: {emg_data_1.size}")
-        print(f"Duration: {emg_ts[-1] - emg_ts[0]:.2f} s")
-        print(f"Approx. sampling rate: {fs:.1f} Hz")
-        print(f"Amplitude range: [{emg_data_1.min():.3f}, {emg_data_1.max():.3f}]")
-        print(f"Any NaNs? {np.isnan(emg_data_1).any()}")
+        # --- Marker raster plot (timing & codes) ---
+        if marker_stream is not None and len(m_ts) > 0:
+            import matplotlib.pyplot as plt
 
-    # --- Marker info ---
-    if marker_stream is not None:
-        m_ts = np.asarray(marker_stream["time_stamps"])
-        m_data = marker_stream["time_series"]
-        markers_flat = [row[0] for row in m_data]  # usually 2D
-
-        print("\n=== Marker basic info ===")
-        print(f"Number of markers: {len(markers_flat)}")
-        uniq = sorted(set(markers_flat))
-        print(f"Unique marker values (up to 20): {uniq[:20]}")
-    else:
-        m_ts = None
-
-    # --- Marker raster plot (timing & codes) ---
-    if marker_stream is not None and len(m_ts) > 0:
-        import matplotlib.pyplot as plt
-
-        t0 = emg_ts[0]  # align marker times to EMG start
-        times_rel = m_ts - t0
-        codes = [int(c) for c in markers_flat]
-
-        # Map each unique code to a separate y-level
-        uniq_codes = sorted(set(codes))
-        code_to_y = {code: i for i, code in enumerate(uniq_codes)}
-        y_vals = [code_to_y[c] for c in codes]
-
-        plt.figure(figsize=(12, 4))
-        plt.scatter(times_rel, y_vals, s=12)
-        plt.yticks(range(len(uniq_codes)), [str(c) for c in uniq_codes])
-        plt.xlabel("Time (s)")
-        plt.ylabel("Marker code")
-        plt.title("Marker raster (codes over time)")
-        plt.tight_layout()
-        plt.show()
-
-
-
-    # === PLOTS ===
-    if emg_data_1.size >= 2 and emg_ts.size >= 2:
-        t0 = emg_ts[0]
-        t_rel = emg_ts - t0
-
-        # --- Full recording, channel 1 + markers ---
-        plt.figure(figsize=(12, 4))
-        plt.plot(t_rel, emg_data_1, linewidth=0.5)
-        if m_ts is not None:
-            for t in m_ts:
-                plt.axvline(t - t0, alpha=0.15)
-        plt.xlabel("Time (s)")
-        plt.ylabel("EMG (a.u.)")
-        plt.title("Full EMG recording (channel 1)")
-        plt.tight_layout()
-
-        # --- First 10 s, channel 1 + markers ---
-        plt.figure(figsize=(12, 4))
-        plt.plot(t_rel, emg_data_1, linewidth=0.5)
-        if m_ts is not None:
-            for t in m_ts:
-                if 0 <= (t - t0) <= 10:
-                    plt.axvline(t - t0, alpha=0.5)
-        plt.xlim(0, 10)
-        plt.xlabel("Time (s)")
-        plt.ylabel("EMG (a.u.)")
-        plt.title("EMG + markers (first 10 s)")
-        plt.tight_layout()
-
-        # --- All 6 channels: full recording ---
-        if emg_data.shape[1] == 6:
-            plt.figure(figsize=(14, 10))
-            for ch in range(6):
-                ax = plt.subplot(6, 1, ch + 1)
-                ax.plot(t_rel, emg_data[:, ch], linewidth=0.5)
-                if m_ts is not None:
-                    for t in m_ts:
-                        ax.axvline(t - t0, alpha=0.08)
-                ax.set_ylabel(f"Ch {ch+1}")
-                if ch == 0:
-                    ax.set_title("All 6 EMG channels (full recording)")
-                if ch < 5:
-                    ax.set_xticklabels([])
+            t0 = emg_ts[0]  # align marker times to EMG start
+            times_rel = m_ts - t0
+            codes = markers_flat.astype(np.int32, copy=False)
+
+            # Map each unique code to a separate y-level (index into sorted codes)
+            uniq_codes, y_vals = np.unique(codes, return_inverse=True)
+
+            plt.figure(figsize=(12, 4))
+            plt.scatter(times_rel, y_vals, s=12)
+            plt.yticks(range(len(uniq_codes)), [str(c) for c in uniq_codes.tolist()])
             plt.xlabel("Time (s)")
+            plt.ylabel("Marker code")
+            plt.title("Marker raster (codes over time)")
             plt.tight_layout()
+            plt.show()
+
+
+
+        # === PLOTS ===
+        if emg_data_1.size >= 2 and emg_ts.size >= 2:
+            t0 = emg_ts[0]
+            t_rel = emg_ts - t0
 
-            # --- All 6 channels: first 10 s ---
+            # Marker times relative to EMG start (all, and first 10 s only)
+            if m_ts is not None:
+                m_rel = m_ts - t0
+                m_rel_10 = m_rel[(m_rel >= 0) & (m_rel <= 10)]
+
+            # Samples in the first 10 s, for the zoomed views
             mask = t_rel <= 10
-            plt.figure(figsize=(14, 10))
-            for ch in range(6):
-                ax = plt.subplot(6, 1, ch + 1)
-                ax.plot(t_rel[mask], emg_data[mask, ch], linewidth=0.5)
-                if m_ts is not None:
-                    for t in m_ts:
-                        if 0 <= (t - t0) <= 10:
-                            ax.axvline(t - t0, alpha=0.3)
-                ax.set_ylabel(f"Ch {ch+1}")
-                if ch == 0:
-                    ax.set_title("All 6 EMG channels (first 10 s)")
-                if ch < 5:
-                    ax.set_xticklabels([])
+
+            # --- Full recording, channel 1 + markers ---
+            plt.figure(figsize=(12, 4))
+            plt.plot(*downsample_for_plot(t_rel, emg_data_1), linewidth=0.5)
+            if m_ts is not None:
+                add_marker_lines(plt.gca(), m_rel, alpha=0.15)
             plt.xlabel("Time (s)")
+            plt.ylabel("EMG (a.u.)")
+            plt.title("Full EMG recording (channel 1)")
             plt.tight_layout()
 
-        plt.show()
-    else:
-        print("\n⚠ Skipping plots because there are fewer than 2 EMG samples.")
-
-    # --- Optional: load stim log CSV ---
-    if STIM_LOG_PATH is not None:
-        if os.path.exists(STIM_LOG_PATH):
-            print(f"\n📂 Loading stim log CSV: {STIM_LOG_PATH}")
-            log = pd.read_csv(STIM_LOG_PATH)
-            print("Columns:", list(log.columns))
-            print("\nFirst 5 rows:")
-            print(log.head())
+            # --- First 10 s, channel 1 + markers ---
+            plt.figure(figsize=(12, 4))
+            plt.plot(*downsample_for_plot(t_rel[mask], emg_data_1[mask], target=2000),
+                     linewidth=0.5)
+            if m_ts is not None:
+                add_marker_lines(plt.gca(), m_rel_10, alpha=0.5)
+            plt.xlim(0, 10)
+            plt.xlabel("Time (s)")
+            plt.ylabel("EMG (a.u.)")
+            plt.title("EMG + markers (first 10 s)")
+            plt.tight_layout()
+
+            # --- All 6 channels: full recording ---
+            if emg_data.shape[0] == 6:
+                plt.figure(figsize=(14, 10))
+                for ch in range(6):
+                    ax = plt.subplot(6, 1, ch + 1)
+                    ax.plot(*downsample_for_plot(t_rel, emg_data[ch]), linewidth=0.5)
+                    if m_ts is not None:
+                        add_marker_lines(ax, m_rel, alpha=0.08)
+                    ax.set_ylabel(f"Ch {ch+1}")
+                    if ch == 0:
+                        ax.set_title("All 6 EMG channels (full recording)")
+                    if ch < 5:
+                        ax.set_xticklabels([])
+                plt.xlabel("Time (s)")
+                plt.tight_layout()
+
+                # --- All 6 channels: first 10 s ---
+                plt.figure(figsize=(14, 10))
+                for ch in range(6):
+                    ax = plt.subplot(6, 1, ch + 1)
+                    ax.plot(*downsample_for_plot(t_rel[mask], emg_data[ch, mask],
+                                                 target=2000),
+                            linewidth=0.5)
+                    if m_ts is not None:
+                        add_marker_lines(ax, m_rel_10, alpha=0.3)
+                    ax.set_ylabel(f"Ch {ch+1}")
+                    if ch == 0:
+                        ax.set_title("All 6 EMG channels (first 10 s)")
+                    if ch < 5:
+                        ax.set_xticklabels([])
+                plt.xlabel("Time (s)")
+                plt.tight_layout()
+
+            plt.show()
         else:
-            print(f"\n⚠ Stim log CSV not found:\n{STIM_LOG_PATH}")
+            print("\n⚠ Skipping plots because there are fewer than 2 EMG samples.")
+
+        # --- Optional: load stim log CSV ---
+        if STIM_LOG_PATH is not None:
+            if os.path.exists(STIM_LOG_PATH):
+                print(f"\n📂 Loading stim log CSV: {STIM_LOG_PATH}")
+                log = pd.read_csv(STIM_LOG_PATH)
+                print("Columns:", list(log.columns))
+                print("\nFirst 5 rows:")
+                print(log.head())
+            else:
+                print(f"\n⚠ Stim log CSV not found:\n{STIM_LOG_PATH}")
+    finally:
+        # --- Remove the temporary EMG memmap ---
+        if emg_tmp_path is not None:
+            del emg_data, emg_data_1
+            try:
+                os.remove(emg_tmp_path)
+            except OSError:  # e.g. still mapped by a plot on Windows
+                print(f"⚠ Could not remove temporary file:\n{emg_tmp_path}")
 
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(description="Quick checker for Kraken EMG XDF + PsychoPy log.")
+    parser.add_argument("--sync", action="store_true",
+                        help="synchronize clocks and dejitter timestamps when loading the XDF")
+    args = parser.parse_args()
+    main(sync=args.sync)
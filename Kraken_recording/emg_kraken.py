@@ -1,16 +1,27 @@
 # EEG/EMG protocol - EMG-only, LSL-only version
 
 # -*- coding: utf-8 -*-
-from psychopy import core, visual, event, gui, prefs
-import psychopy  # for psychopy.__version__
 from pylsl import StreamInfo, StreamOutlet, local_clock
-import os, random, re, gc
-from collections import OrderedDict
-import csv, time
+import os, random, re, gc, operator, threading
+import array, csv, time
 import json
+from concurrent.futures import ThreadPoolExecutor, wait
+
+# PsychoPy is imported on first use (see _import_psychopy), so the marker
+# helpers and MOVEMENTS can be imported without loading PsychoPy
+psychopy = core = visual = event = gui = logging = None
+
+
+def _import_psychopy():
+    global psychopy, core, visual, event, gui, logging
+    import psychopy  # for psychopy.__version__
+    from psychopy import prefs
+
+    # Prefer stable movie backends (harmless if missing)
+    prefs.general['moviesLib'] = ['ffpyplayer', 'moviepy', 'avbin']
+
+    from psychopy import core, visual, event, gui, logging
 
-# Prefer stable movie backends (harmless if missing)
-prefs.general['moviesLib'] = ['ffpyplayer', 'moviepy', 'avbin']
 
 SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
 
@@ -43,8 +54,14 @@ def strip_baseline_suffix(lbl: str) -> str:
     return _strip_bl.sub("", lbl)
 
 
+_BASELINE_PREFIXES = ("1_up_", "2_side_", "3_down_")
+
+
 def movement_root(key_or_file: str) -> str:
-    return re.sub(r"^(?:1_up_|2_side_|3_down_)", "", key_or_file)
+    for prefix in _BASELINE_PREFIXES:
+        if key_or_file.startswith(prefix):
+            return key_or_file[len(prefix):]
+    return key_or_file
 
 
 # ----------------------------- Markers -----------------------------
@@ -63,21 +80,78 @@ def make_marker(phase_code: int, arm_code: int, base_code: int,
     return phase_code * 10000 + arm_code * 1000 + base_code * 100 + move_code
 
 
-def push_event_codes(outlet, arm: str, phase: str,
-                     base_code: int, move_code: int) -> int:
+# One-sample int32 buffer reused for every marker push (no list per event)
+_marker_buf = array.array('i', [0])
+
+
+# (local_clock, perf_counter) at the last marker push, see last_marker_time()
+_last_push = (0.0, 0.0)
+
+
+def push_marker(outlet, lsl_marker: int) -> None:
+    """Push one marker now and flush it to the network immediately."""
+    global _last_push
+    ts = local_clock()
+    _marker_buf[0] = lsl_marker
+    outlet.push_sample(_marker_buf, timestamp=ts, pushthrough=True)
+    _last_push = (ts, time.perf_counter())
+
+
+# (outlet, marker) queued for the next flip and not sent yet
+_pending_marker = None
+
+
+def _push_pending():
+    global _pending_marker
+    if _pending_marker is not None:
+        outlet, lsl_marker = _pending_marker
+        _pending_marker = None
+        push_marker(outlet, lsl_marker)
+
+
+def queue_marker(win, outlet, lsl_marker: int) -> None:
+    """
+    Send the marker when the next win.flip() returns (onset of the event's
+    first frame); the timestamp is taken in the callback, at flip time.
     """
-    Send an LSL marker on `outlet`.
+    global _pending_marker
+    _push_pending()  # an earlier marker whose flip never came goes now
+    _pending_marker = (outlet, lsl_marker)
+    win.callOnFlip(_push_pending)
+
+
+def last_marker_time():
+    """
+    (lsl_t, perf_t) of the last marker pushed: its LSL timestamp, and the
+    matching time.perf_counter() to measure the event's duration from.
+    A queued marker whose event drew no frame (e.g. a zero-length countdown)
+    is sent now, so it never lands on the next event's first flip.
+    """
+    _push_pending()
+    return _last_push
+
+
+def event_code(arm: str, phase: str, base_code: int, move_code: int) -> int:
+    """
+    Marker for a task event, without sending it.
 
     Returns
     -------
     lsl_marker : int
         Integer marker = phase*10000 + arm*1000 + base*100 + move.
     """
-    phase_code = PHASE[phase]
-    arm_code = ARM_CODES[arm]
+    return make_marker(PHASE[phase], ARM_CODES[arm], base_code, move_code)
+
 
-    lsl_marker = make_marker(phase_code, arm_code, base_code, move_code)
-    outlet.push_sample([lsl_marker], timestamp=local_clock())
+def push_event_on_flip(win, outlet, arm: str, phase: str,
+                       base_code: int, move_code: int) -> int:
+    """
+    Queue the LSL marker to be sent when the next win.flip() returns, i.e.
+    at the onset of the first frame of the event. The timestamp is taken
+    inside the callback, at flip time. Returns the marker.
+    """
+    lsl_marker = event_code(arm, phase, base_code, move_code)
+    queue_marker(win, outlet, lsl_marker)
     return lsl_marker
 
 
@@ -87,9 +161,25 @@ REST_CODES = {"eyes_open": 9701, "eyes_closed": 9702}
 
 
 # ----------------- Functions to Run Task -----------------------------
+# Screen refresh rate (Hz), measured once by measure_frame_rate()
+_frame_rate = None
+
+
+def measure_frame_rate(win, fallback=60.0):
+    global _frame_rate
+    _frame_rate = win.getActualFrameRate() or fallback
+    return _frame_rate
+
+
 def _timed_screen(win, draw_callables, seconds):
+    # Redraw and flip every frame (each win.flip() waits for vsync) and stop on
+    # the clock half a frame early, so the hold ends on the refresh closest to
+    # `seconds` without trusting the frame-rate estimate for the duration
+    if _frame_rate is None:
+        measure_frame_rate(win)
+    end = float(seconds) - 0.5 / _frame_rate
     clk = core.Clock()
-    while clk.getTime() < float(seconds):
+    while clk.getTime() < end:
         if 'escape' in event.getKeys(['escape']):
             core.quit()
         for d in draw_callables:
@@ -97,7 +187,8 @@ def _timed_screen(win, draw_callables, seconds):
         win.flip()
 
 
-def record_resting_state(win, outlet, event_log, label_stim, fix_stim,
+def record_resting_state(win, outlet, record_event, label_stim, fix_stim,
+                         closed_label_stim,
                          psycho_ver, subject_id, eeg_fs, emg_fs,
                          do_open=True, open_sec=60.0,
                          do_closed=True, closed_sec=60.0):
@@ -111,21 +202,21 @@ def record_resting_state(win, outlet, event_log, label_stim, fix_stim,
     # --- Eyes OPEN ---
     if do_open and open_sec > 0:
         label_stim.text = "Resting — eyes OPEN (fixate)"
-        t_start = local_clock()
 
         # LSL marker
         lsl_marker = REST_CODES["eyes_open"]
-        outlet.push_sample([lsl_marker])
+        queue_marker(win, outlet, lsl_marker)
 
         hw_trigger = None  # no hardware triggers
 
         _timed_screen(win, [fix_stim, label_stim], float(open_sec))
-        t_end = local_clock()
-        event_log.append({
+        t_start, p_start = last_marker_time()
+        duration = time.perf_counter() - p_start
+        record_event({
             "phase": "rest_open",
             "lsl_t_start": t_start,
-            "lsl_t_end": t_end,
-            "duration_s": t_end - t_start,
+            "lsl_t_end": t_start + duration,
+            "duration_s": duration,
             "lsl_marker": lsl_marker,
             "arduino_trigger": hw_trigger,
             "subject_id": subject_id,
@@ -143,25 +234,22 @@ def record_resting_state(win, outlet, event_log, label_stim, fix_stim,
 
     # --- Eyes CLOSED ---
     if do_closed and closed_sec > 0:
-        closed_label = visual.TextStim(
-            win, text="Resting — eyes CLOSED", color="white",
-            height=0.035, pos=(0, -0.45)
-        )
-        t_start = local_clock()
+        closed_label_stim.text = "Resting — eyes CLOSED"
 
         # LSL marker
         lsl_marker = REST_CODES["eyes_closed"]
-        outlet.push_sample([lsl_marker])
+        queue_marker(win, outlet, lsl_marker)
 
         hw_trigger = None  # no hardware triggers
 
-        _timed_screen(win, [closed_label], float(closed_sec))
-        t_end = local_clock()
-        event_log.append({
+        _timed_screen(win, [closed_label_stim], float(closed_sec))
+        t_start, p_start = last_marker_time()
+        duration = time.perf_counter() - p_start
+        record_event({
             "phase": "rest_closed",
             "lsl_t_start": t_start,
-            "lsl_t_end": t_end,
-            "duration_s": t_end - t_start,
+            "lsl_t_end": t_start + duration,
+            "duration_s": duration,
             "lsl_marker": lsl_marker,
             "arduino_trigger": hw_trigger,
             "subject_id": subject_id,
@@ -180,6 +268,8 @@ def record_resting_state(win, outlet, event_log, label_stim, fix_stim,
 
 # ----------------------------- GUI  -----------------------------
 def setup_gui():
+    _import_psychopy()
+
     # -1) Subject & acquisition params
     dS = gui.Dlg(title="Participant / Acquisition")
     dS.addField("Subject ID (e.g. sub-001)", "sub-001")
@@ -243,7 +333,7 @@ def setup_gui():
     mid = n // 2 if n > 1 else n
 
     def movement_page(page_items, title, defaults_yes_budget, offset):
-        fields = OrderedDict()
+        fields = {}
         label_to_key = {}
         for i, (k, v) in enumerate(page_items):
             label = strip_baseline_suffix(v["label"])
@@ -284,7 +374,7 @@ def setup_gui():
         core.quit()
 
     # Arms (checkboxes)
-    arms_dict = OrderedDict([("Left arm", True), ("Right arm", True)])
+    arms_dict = {"Left arm": True, "Right arm": True}
     d_arms = gui.DlgFromDict(
         dictionary=arms_dict, title="Experiment Setup — Arms",
         order=list(arms_dict.keys())
@@ -317,7 +407,9 @@ def setup_gui():
     d2.addField("# reps per movement", 6)
     d2.addField("Order", choices=["Random", "Ordered"], initial="Random")
     d2.addField("Inter-block fix", 5.0)
-    d2.addField("Test LSL pings?", choices=["Yes", "No"], initial="Yes")
+    # Test pings default to off unless KRAKEN_DEBUG is set in the environment
+    d2.addField("Test LSL pings?", choices=["Yes", "No"],
+                initial="Yes" if os.environ.get("KRAKEN_DEBUG") else "No")
     d2.addField("Fullscreen?", choices=["Yes", "No"], initial="Yes")
     ok2 = d2.show()
     if not d2.OK:
@@ -366,38 +458,181 @@ def arm_candidates(basefile, arm):
     a = arm.lower()
     # try arm-suffixed then generic; try common extensions if needed
     bases = [f"{s}_{a}", s]
-    exts = [e] if e else []
-    for ext in [".mp4", ".mov", ".MP4", ".MOV"]:
-        if ext not in exts:
-            exts.append(ext)
-    return [b + ext for b in bases for ext in exts]
+    exts = ([e] if e else []) + [".mp4", ".mov"]
+    # resolve_media_path looks names up by casefold(), so candidates are
+    # deduplicated the same way (first spelling kept, order preserved)
+    candidates = {}
+    for b in bases:
+        for ext in exts:
+            candidates.setdefault((b + ext).casefold(), b + ext)
+    return list(candidates.values())
+
+
+# File names in MEDIA_DIR, read once with os.scandir (see _media_files):
+#   name.casefold() -> name on disk, so lookups are case-insensitive like
+#   os.path.exists on the Windows/macOS recording machines
+_MEDIA_FILES = None
+
+
+def _media_files():
+    global _MEDIA_FILES
+    if _MEDIA_FILES is None:
+        try:
+            with os.scandir(MEDIA_DIR) as it:
+                _MEDIA_FILES = {
+                    entry.name.casefold(): entry.name
+                    for entry in it if entry.is_file()
+                }
+        except FileNotFoundError:
+            _MEDIA_FILES = {}
+    return _MEDIA_FILES
+
+
+# Media files that could not be resolved; reported once (see main)
+_missing = set()
 
 
 def resolve_media_path(move_key, arm):
     basefile = MOVEMENTS[move_key]["file"]
+    media_files = _media_files()
     for fname in arm_candidates(basefile, arm):
-        p = os.path.join(MEDIA_DIR, fname)
-        if os.path.exists(p):
-            return p
+        on_disk = media_files.get(fname.casefold())
+        if on_disk is not None:
+            return os.path.join(MEDIA_DIR, on_disk)
     # If not found, return None (we’ll show a label instead of a video)
-    print("video not found:", basefile)
+    _missing.add(basefile)
     return None
 
 
 # ----------------------------- Playback -----------------------------
-def play_movie_robust(win, path, overlay_text="", dur=None):
+# One MovieStim per video path, reused across cues/reps:
+#   path -> (stim, n_frames, duration)
+_movie_cache = {}
+
+
+def _load_movie(win, path):
+    """Create a MovieStim for `path`, read its metadata and cache it."""
+    stim = visual.MovieStim(win, path, loop=False)
+
+    # Try to read metadata
+    fps = n_frames = duration = None
+    try:
+        fps = stim.getMovieFrameRate()
+    except Exception:
+        pass
+    try:
+        n_frames = stim.nFrames
+    except Exception:
+        pass
+    try:
+        duration = stim.duration
+    except Exception:
+        pass
+    if duration is None and fps and n_frames:
+        duration = float(n_frames) / float(fps)
+
+    entry = (stim, n_frames, duration)
+    _movie_cache[path] = entry
+    return entry
+
+
+def _prefetch_media(path):
+    """
+    Open `path` once off the GL thread (ffpyplayer, paused) so the file is
+    in the OS cache and its headers are probed before MovieStim opens it.
+    """
+    try:
+        from ffpyplayer.player import MediaPlayer
+    except ImportError:
+        # no ffpyplayer: at least pull the file into the OS page cache
+        with open(path, "rb") as f:
+            while f.read(1 << 20):
+                pass
+        return
+    player = MediaPlayer(path, ff_opts={"paused": True, "an": True})
+    try:
+        player.get_metadata()
+    finally:
+        player.close_player()
+
+
+def preload_movie(win, path, max_wait):
+    """
+    Warm up and cache the MovieStim for `path` (used during fixations).
+    Probing runs in a thread for at most `max_wait` s; the MovieStim itself
+    must be created here, on the GL thread.
+    """
+    if not path or path in _movie_cache:
+        return
+    t = threading.Thread(target=_prefetch_media, args=(path,), daemon=True)
+    t.start()
+    t.join(timeout=max_wait)
+    try:
+        _load_movie(win, path)
+    except Exception:
+        pass  # play_movie_robust will show its fallback label
+
+
+def preload_all_movies(win, paths, screen, seconds, max_wait=10.0,
+                       max_workers=4):
+    """
+    Cache a MovieStim for every video in `paths` before the run starts.
+    Files are probed in a thread pool while `screen` is shown for `seconds`,
+    and for at most `max_wait` s more if probes are still running (the
+    screen keeps flipping and Escape still works). The MovieStims are then
+    created one by one here, on the GL thread, with a progress line under
+    the screen text.
+    """
+    paths = [p for p in dict.fromkeys(paths) if p and p not in _movie_cache]
+    pool = ThreadPoolExecutor(max_workers=max_workers)
+    pending = {pool.submit(_prefetch_media, path) for path in paths}
+    _timed_screen(win, [screen], seconds)
+    clk = core.Clock()
+    while pending and clk.getTime() < max_wait:
+        _timed_screen(win, [screen], 0.1)
+        _, pending = wait(pending, timeout=0)
+    # don't block on a probe that hangs; queued ones are dropped
+    pool.shutdown(wait=False, cancel_futures=True)
+
+    text = screen.text
+    for k, path in enumerate(paths, 1):
+        screen.text = f"{text}\n\nLoading videos {k}/{len(paths)}"
+        screen.draw()
+        win.flip()
+        try:
+            _load_movie(win, path)
+        except Exception:
+            pass  # play_movie_robust will show its fallback label
+    screen.text = text
+
+
+def release_movies():
+    """Unload every cached MovieStim (call once at the end of the run)."""
+    for stim, _, _ in _movie_cache.values():
+        try:
+            stim.stop()
+        except Exception:
+            pass
+    _movie_cache.clear()
+
+
+def play_movie_robust(win, path, overlay_stim, msg_stim, overlay_text="",
+                      dur=None):
     """
-    Create a MovieStim, play it from start, and stop when:
+    Play the (cached) MovieStim for `path` from the start, and stop when:
       - movie finishes (status), OR
       - last frame reached / frames stall, OR
       - elapsed time >= dur (if dur specified), else duration + margin.
+    overlay_stim (label under the video) and msg_stim (missing/failed video
+    text) are created once in main() and only get new text here.
     """
     # If no path (missing media), show text for requested duration
-    if not path or not os.path.exists(path):
-        msg = visual.TextStim(
-            win, text=overlay_text or "Missing video",
-            color="black", height=0.05, pos=(0, -0.45)
-        )
+    # (paths come from the one-time scandir index; a file that vanished since
+    # is handled by the _load_movie fallback below)
+    if not path:
+        msg = msg_stim
+        msg.text = overlay_text or "Missing video"
+        msg.pos = (0, -0.45)
         clk = core.Clock()
         while dur is None or clk.getTime() < float(dur):
             if 'escape' in event.getKeys(['escape']):
@@ -406,15 +641,23 @@ def play_movie_robust(win, path, overlay_text="", dur=None):
             win.flip()
         return
 
-    # Create MovieStim
-    try:
-        stim = visual.MovieStim(win, path, loop=False)
-    except Exception:
+    # Reuse the cached MovieStim (rewound to start), or create it
+    entry = _movie_cache.get(path)
+    if entry is not None:
+        try:
+            entry[0].seek(0.0)
+        except Exception:
+            pass
+    else:
+        try:
+            entry = _load_movie(win, path)
+        except Exception:
+            entry = None
+    if entry is None:
         # fallback: show label if creation fails
-        msg = visual.TextStim(
-            win, text=f"Video error:\n{os.path.basename(path)}",
-            color="black", height=0.05
-        )
+        msg = msg_stim
+        msg.text = f"Video error:\n{os.path.basename(path)}"
+        msg.pos = (0, 0)
         clk = core.Clock()
         while dur is None or clk.getTime() < float(dur):
             if 'escape' in event.getKeys(['escape']):
@@ -424,27 +667,12 @@ def play_movie_robust(win, path, overlay_text="", dur=None):
         return
 
     # Optional overlay label (movement/arm)
-    overlay = visual.TextStim(
-        win, text=overlay_text, color="black",
-        height=0.04, pos=(0, -0.45)
-    ) if overlay_text else None
+    overlay = None
+    if overlay_text:
+        overlay = overlay_stim
+        overlay.text = overlay_text
 
-    # Try to read metadata
-    fps = n_frames = duration = None
-    try:
-        fps = stim.getMovieFrameRate()
-    except Exception:
-        pass
-    try:
-        n_frames = stim.nFrames
-    except Exception:
-        pass
-    try:
-        duration = stim.duration
-    except Exception:
-        pass
-    if duration is None and fps and n_frames:
-        duration = float(n_frames) / float(fps)
+    stim, n_frames, duration = entry
 
     # Start playback
     try:
@@ -459,15 +687,25 @@ def play_movie_robust(win, path, overlay_text="", dur=None):
     cap = float(dur) if dur is not None else (
         None if duration is None else duration + margin
     )
+    if _frame_rate is None:
+        measure_frame_rate(win)
+    frame_period = 1.0 / _frame_rate
 
+    n_flips = 0
     while True:
-        if 'escape' in event.getKeys(['escape']):
+        # escape is polled every 10 frames (~150 ms at 60 Hz)
+        if n_flips % 10 == 0 and 'escape' in event.getKeys(['escape']):
             core.quit()
 
+        # C) cap by time: stop if the next frame would end past the cap
+        if cap is not None and clk.getTime() > cap - frame_period:
+            break
+
         stim.draw()
         if overlay:
             overlay.draw()
         win.flip()
+        n_flips += 1
 
         # A) declared finished
         try:
@@ -484,20 +722,16 @@ def play_movie_robust(win, path, overlay_text="", dur=None):
         except Exception:
             pass
 
-        # C) cap by time
-        if cap is not None and clk.getTime() >= cap:
-            break
-
         # safety
         if clk.getTime() > 300:
             break
 
+    # Pause rather than stop: stop() unloads the movie, the cached stim is
+    # rewound and replayed next time
     try:
-        stim.stop()
+        stim.pause()
     except Exception:
         pass
-    stim = None
-    gc.collect()
     core.wait(0.05)  # brief settle
 
 
@@ -509,13 +743,13 @@ def show_countdown(win, secs, txt_stim):
         if 'escape' in event.getKeys(['escape']):
             core.quit()
         txt_stim.text = str(t)
-        txt_stim.draw()
-        win.flip()
-        core.wait(1.0)
+        _timed_screen(win, [txt_stim], 1.0)
 
 
 # ----------------------------- Main -----------------------------
 def main():
+    _import_psychopy()
+
     # LSL outlet once
     info = StreamInfo(name='stimulus_stream', type='Markers', channel_count=1,
                       channel_format='int32', source_id='stimulus_stream_001')
@@ -527,11 +761,14 @@ def main():
     # Config
     cfg = setup_gui()
 
-    # Single window for the whole run; skip frame-rate measurement
+    # Single window for the whole run; skip PsychoPy's startup timing check
     win = visual.Window(
         fullscr=cfg["fs"], units='height',
         color="black", checkTiming=False
     )
+    # Measure the refresh rate once; timed screens use it for their half-frame
+    # early stop, movies for their end-of-cap check
+    measure_frame_rate(win)
 
     # UI stims
     fix = visual.TextStim(win, text="+", color="white", height=0.05)
@@ -563,9 +800,22 @@ def main():
         text="Perform the movement synchronized with the video",
         color="white", height=0.05
     )
+    closed_label = visual.TextStim(
+        win, text="Resting — eyes CLOSED", color="white",
+        height=0.035, pos=(0, -0.45)
+    )
+    # Reused by play_movie_robust for every cue / move
+    movie_overlay = visual.TextStim(
+        win, text="", color="black",
+        height=0.04, pos=(0, -0.45)
+    )
+    movie_msg = visual.TextStim(win, text="", color="black", height=0.05)
+    new_block_instruction = visual.TextStim(
+        win, text="", color="white", height=0.05
+    )
+    msg = visual.TextStim(win, text="", color="white", height=0.035)
 
-    # --- event log (per-event rows) ---
-    event_log = []
+    # --- per-event info ---
     psycho_ver = psychopy.__version__
     subject_id = cfg["subject_id"]
     eeg_fs = cfg["eeg_fs"]
@@ -587,17 +837,95 @@ def main():
     if cfg["order"].lower().startswith("rand"):
         random.shuffle(blocks)
 
+    # --- Output files: rows are written (and flushed) as events happen ---
+    # Original event log (CSV)
+    log_dir = os.path.join(os.getcwd(), "logs")
+    os.makedirs(log_dir, exist_ok=True)
+    log_name = f"stim_log_{time.strftime('%Y%m%d_%H%M%S')}.csv"
+    log_path = os.path.join(log_dir, log_name)
+
+    fieldnames = [
+        "phase", "lsl_t_start", "lsl_t_end", "duration_s",
+        "lsl_marker", "arduino_trigger",
+        "subject_id", "block", "rep", "arm", "base_code", "move_code",
+        "movement_key", "file", "psychopy_version", "eeg_fs", "emg_fs"
+    ]
+
+    f_log = open(log_path, "w", newline="", encoding="utf-8")
+    w_log = csv.DictWriter(f_log, fieldnames=fieldnames)
+    w_log.writeheader()
+
+    # BIDS-style events export (EMG-only)
+    # Root: Data/raw/<sub>/ses-XXX/eeg-emg/
+    bids_root = os.path.join(os.getcwd(), "Data", "raw")
+    session_label = cfg["session_label"]
+    sub_dir = os.path.join(bids_root, subject_id, session_label, "emg_kraken")
+    os.makedirs(sub_dir, exist_ok=True)
+
+    events_base = f"{subject_id}_{session_label}_task_events"
+    events_path = os.path.join(sub_dir, events_base + ".tsv")
+    events_json_path = os.path.join(sub_dir, events_base + ".json")
+
+    f_ev = open(events_path, "w", newline="", encoding="utf-8")
+    w_ev = csv.writer(f_ev, delimiter="\t")
+    w_ev.writerow([
+        "onset", "duration", "trial_type",
+        "arm", "base_code", "move_code", "movement_key",
+        "block", "rep",
+        "lsl_marker", "arduino_trigger"
+    ])
+
+    # TSV columns copied from the event dict as-is, fetched in one C call
+    tsv_fields = operator.itemgetter(
+        "arm", "base_code", "move_code", "movement_key",
+        "block", "rep", "lsl_marker", "arduino_trigger"
+    )
+
+    # onset is relative to the first logged event
+    t0 = None
+    n_events = 0
+
+    def record_event(ev):
+        nonlocal t0, n_events
+        if t0 is None:
+            t0 = ev["lsl_t_start"]
+        w_log.writerow(ev)
+        onset = float(ev["lsl_t_start"] - t0) if ev["lsl_t_start"] is not None else ""
+        duration = float(ev["duration_s"]) if ev["duration_s"] is not None else ""
+        w_ev.writerow((onset, duration, ev["phase"], *tsv_fields(ev)))
+        # flush so a crash mid-run keeps everything logged so far
+        f_log.flush()
+        f_ev.flush()
+        n_events += 1
+
+    # No automatic GC during the run: long-lived window/stim objects are frozen
+    # out of future sweeps, and collection only happens in ITI / inter-block
+    # fixations, where a short pause cannot delay a flip
+    gc.freeze()
+    gc.disable()
+
+    # Resolve every block's video before recording starts
+    media_paths = {
+        (arm, mkey): resolve_media_path(mkey, arm) for arm, mkey in blocks
+    }
+    if _missing:
+        logging.warning(
+            f"{len(_missing)} video(s) not found in {MEDIA_DIR}: "
+            + ", ".join(sorted(_missing))
+        )
+
     # Optional LSL test pings
     if cfg["test"]:
-        for _ in range(5):
-            outlet.push_sample([9999])
-            core.wait(0.5)
+        # one ping stamped now (marker timestamps stay monotonic), short wait
+        push_marker(outlet, 9999)
+        core.wait(0.1)
 
     # Ready screen
     ready.draw()
+    queue_marker(win, outlet, 8888)
     win.flip()
-    outlet.push_sample([8888])
-    core.wait(1.5)
+    # open every block's video while the operator arms LabRecorder
+    preload_all_movies(win, media_paths.values(), ready, 1.5)
 
     # Pre-run global countdown
     if cfg["cdown"] > 0:
@@ -606,8 +934,8 @@ def main():
     # Optional resting-state at experiment start
     if cfg["rest_open"] or cfg["rest_closed"]:
         record_resting_state(
-            win=win, outlet=outlet, event_log=event_log,
-            label_stim=label, fix_stim=fix,
+            win=win, outlet=outlet, record_event=record_event,
+            label_stim=label, fix_stim=fix, closed_label_stim=closed_label,
             psycho_ver=psycho_ver, subject_id=subject_id,
             eeg_fs=eeg_fs, emg_fs=emg_fs,
             do_open=cfg["rest_open"], open_sec=cfg["rest_open_sec"],
@@ -619,231 +947,149 @@ def main():
         move_code = MOVEMENTS[mkey]["code"]
         base_code = MOVEMENTS[mkey]["baseline_code"]
 
-        # Resolve best file for this arm (tries *_left/_right then generic)
-        media_path = resolve_media_path(mkey, arm)
+        # Best file for this arm (tries *_left/_right then generic)
+        media_path = media_paths[(arm, mkey)]
         nice_label = f"{arm.upper()} — {strip_baseline_suffix(MOVEMENTS[mkey]['label'])}"
 
+        # Fields shared by every event of this block
+        base_event = {
+            "arduino_trigger": None,
+            "subject_id": subject_id,
+            "block": bi + 1,
+            "arm": arm,
+            "base_code": base_code,
+            "move_code": move_code,
+            "movement_key": mkey,
+            "file": os.path.basename(media_path) if media_path else None,
+            "psychopy_version": psycho_ver,
+            "eeg_fs": eeg_fs,
+            "emg_fs": emg_fs,
+        }
+
         block_name = mkey
         block_name = block_name[2:].replace("_", " ")
-        new_block_instruction = visual.TextStim(
-            win,
-            text=f"New movement block:\n{block_name}",
-            color="white", height=0.05
-        )
-        new_block_instruction.draw()
-        win.flip()
-        core.wait(4.0)
+        new_block_instruction.text = f"New movement block:\n{block_name}"
+        _timed_screen(win, [new_block_instruction], 4.0)
 
         # CUE INSTRUCTION
-        instruction_prep.draw()
-        win.flip()
-        core.wait(2.0)  # show 2 seconds (or change duration)
+        _timed_screen(win, [instruction_prep], 2.0)  # show 2 seconds (or change duration)
 
         # Fixation before cue
         if cfg["fix"] > 0:
             label.text = nice_label
-            fix.draw()
-            label.draw()
-            win.flip()
-            core.wait(cfg["fix"])
+            _timed_screen(win, [fix, label], cfg["fix"])
 
         # CUE
-        t_start = local_clock()
-        lsl_marker = push_event_codes(outlet, arm, "cue", base_code, move_code)
+        lsl_marker = push_event_on_flip(
+            win, outlet, arm, "cue", base_code, move_code
+        )
         play_movie_robust(
-            win, media_path, overlay_text=nice_label, dur=cfg["cue"]
+            win, media_path, movie_overlay, movie_msg,
+            overlay_text=nice_label, dur=cfg["cue"]
         )
-        t_end = local_clock()
-        event_log.append({
+        t_start, p_start = last_marker_time()
+        duration = time.perf_counter() - p_start
+        record_event({
+            **base_event,
             "phase": "cue",
             "lsl_t_start": t_start,
-            "lsl_t_end": t_end,
-            "duration_s": t_end - t_start,
+            "lsl_t_end": t_start + duration,
+            "duration_s": duration,
             "lsl_marker": lsl_marker,
-            "arduino_trigger": None,
-            "subject_id": subject_id,
-            "block": bi + 1,
             "rep": 0,
-            "arm": arm,
-            "base_code": base_code,
-            "move_code": move_code,
-            "movement_key": mkey,
-            "file": os.path.basename(media_path) if media_path else None,
-            "psychopy_version": psycho_ver,
-            "eeg_fs": eeg_fs,
-            "emg_fs": emg_fs,
         })
 
         for r in range(cfg["reps"]):
             event.clearEvents()
 
             # INSTRUCTION BEFORE MOVE
-            instruction_move.draw()
-            win.flip()
-            core.wait(1.5)  # show for 1.5 sec (adjust as desired)
+            _timed_screen(win, [instruction_move], 1.5)  # show for 1.5 sec (adjust as desired)
 
             # PREP
-            t_start = local_clock()
-            lsl_marker = push_event_codes(
-                outlet, arm, "prep", base_code, move_code
+            lsl_marker = push_event_on_flip(
+                win, outlet, arm, "prep", base_code, move_code
             )
             show_countdown(win, cfg["prep"], countdown)
-            t_end = local_clock()
-            event_log.append({
+            t_start, p_start = last_marker_time()
+            duration = time.perf_counter() - p_start
+            record_event({
+                **base_event,
                 "phase": "prep",
                 "lsl_t_start": t_start,
-                "lsl_t_end": t_end,
-                "duration_s": t_end - t_start,
+                "lsl_t_end": t_start + duration,
+                "duration_s": duration,
                 "lsl_marker": lsl_marker,
-                "arduino_trigger": None,
-                "subject_id": subject_id,
-                "block": bi + 1,
                 "rep": r + 1,
-                "arm": arm,
-                "base_code": base_code,
-                "move_code": move_code,
-                "movement_key": mkey,
-                "file": os.path.basename(media_path) if media_path else None,
-                "psychopy_version": psycho_ver,
-                "eeg_fs": eeg_fs,
-                "emg_fs": emg_fs,
             })
 
             # MOVE (full video recommended; set dur=cfg["perf"] for fixed window)
-            t_start = local_clock()
-            lsl_marker = push_event_codes(
-                outlet, arm, "move", base_code, move_code
+            lsl_marker = push_event_on_flip(
+                win, outlet, arm, "move", base_code, move_code
             )
             play_movie_robust(
-                win, media_path, overlay_text=nice_label, dur=None
+                win, media_path, movie_overlay, movie_msg,
+                overlay_text=nice_label, dur=None
             )
-            t_end = local_clock()
-            event_log.append({
+            t_start, p_start = last_marker_time()
+            duration = time.perf_counter() - p_start
+            record_event({
+                **base_event,
                 "phase": "move",
                 "lsl_t_start": t_start,
-                "lsl_t_end": t_end,
-                "duration_s": t_end - t_start,
+                "lsl_t_end": t_start + duration,
+                "duration_s": duration,
                 "lsl_marker": lsl_marker,
-                "arduino_trigger": None,
-                "subject_id": subject_id,
-                "block": bi + 1,
                 "rep": r + 1,
-                "arm": arm,
-                "base_code": base_code,
-                "move_code": move_code,
-                "movement_key": mkey,
-                "file": os.path.basename(media_path) if media_path else None,
-                "psychopy_version": psycho_ver,
-                "eeg_fs": eeg_fs,
-                "emg_fs": emg_fs,
             })
 
             # RETURN (text only)
             if cfg["ret"] > 0:
-                t_start = local_clock()
-                lsl_marker = push_event_codes(
-                    outlet, arm, "return", base_code, move_code
+                lsl_marker = push_event_on_flip(
+                    win, outlet, arm, "return", base_code, move_code
                 )
 
-                fix.draw()
-                retxt.draw()
-                win.flip()
-                core.wait(cfg["ret"])
-                t_end = local_clock()
-                event_log.append({
+                _timed_screen(win, [fix, retxt], cfg["ret"])
+                t_start, p_start = last_marker_time()
+                duration = time.perf_counter() - p_start
+                record_event({
+                    **base_event,
                     "phase": "return",
                     "lsl_t_start": t_start,
-                    "lsl_t_end": t_end,
-                    "duration_s": t_end - t_start,
+                    "lsl_t_end": t_start + duration,
+                    "duration_s": duration,
                     "lsl_marker": lsl_marker,
-                    "arduino_trigger": None,
-                    "subject_id": subject_id,
-                    "block": bi + 1,
                     "rep": r + 1,
-                    "arm": arm,
-                    "base_code": base_code,
-                    "move_code": move_code,
-                    "movement_key": mkey,
-                    "file": os.path.basename(media_path) if media_path else None,
-                    "psychopy_version": psycho_ver,
-                    "eeg_fs": eeg_fs,
-                    "emg_fs": emg_fs,
                 })
 
             # ITI (send ITI marker if desired)
             if cfg["iti"] > 0:
-                push_event_codes(outlet, arm, "iti", base_code, move_code)
+                push_event_on_flip(
+                    win, outlet, arm, "iti", base_code, move_code
+                )
                 fix.draw()
                 win.flip()
-                core.wait(cfg["iti"])
+                # clock from the ITI onset: the collection runs inside the
+                # ITI and only the remaining time is held
+                iti_clk = core.Clock()
+                gc.collect()
+                _timed_screen(win, [fix], cfg["iti"] - iti_clk.getTime())
 
         # Inter-block fixation
         if bi < len(blocks) - 1 and cfg["ibfix"] > 0:
             fix.draw()
             win.flip()
-            core.wait(cfg["ibfix"])
-
-    # --- save original event log to CSV ---
-    log_dir = os.path.join(os.getcwd(), "logs")
-    os.makedirs(log_dir, exist_ok=True)
-    log_name = f"stim_log_{time.strftime('%Y%m%d_%H%M%S')}.csv"
-    log_path = os.path.join(log_dir, log_name)
-
-    fieldnames = [
-        "phase", "lsl_t_start", "lsl_t_end", "duration_s",
-        "lsl_marker", "arduino_trigger",
-        "subject_id", "block", "rep", "arm", "base_code", "move_code",
-        "movement_key", "file", "psychopy_version", "eeg_fs", "emg_fs"
-    ]
+            ibfix_clk = core.Clock()
+            gc.collect()
+            # open the next block's video while the fixation is on screen
+            preload_movie(win, media_paths[blocks[bi + 1]],
+                          max_wait=cfg["ibfix"])
+            core.wait(max(0.0, cfg["ibfix"] - ibfix_clk.getTime()))
 
-    with open(log_path, "w", newline="", encoding="utf-8") as f:
-        w = csv.DictWriter(f, fieldnames=fieldnames)
-        w.writeheader()
-        w.writerows(event_log)
+    gc.enable()
 
-    # --- BIDS-style events export (EMG-only) ---
-    # Root: Data/raw/<sub>/ses-XXX/eeg-emg/
-    bids_root = os.path.join(os.getcwd(), "Data", "raw")
-    session_label = cfg["session_label"]
-    sub_dir = os.path.join(bids_root, subject_id, session_label, "emg_kraken")
-    os.makedirs(sub_dir, exist_ok=True)
-
-    events_base = f"{subject_id}_{session_label}_task_events"
-    events_path = os.path.join(sub_dir, events_base + ".tsv")
-    events_json_path = os.path.join(sub_dir, events_base + ".json")
-
-    # Compute onset relative to first event
-    if event_log:
-        t0 = event_log[0]["lsl_t_start"]
-    else:
-        t0 = 0.0
-
-    # Write events.tsv
-    with open(events_path, "w", newline="", encoding="utf-8") as f_ev:
-        w_ev = csv.writer(f_ev, delimiter="\t")
-        w_ev.writerow([
-            "onset", "duration", "trial_type",
-            "arm", "base_code", "move_code", "movement_key",
-            "block", "rep",
-            "lsl_marker", "arduino_trigger"
-        ])
-        for ev in event_log:
-            onset = float(ev["lsl_t_start"] - t0) if ev["lsl_t_start"] is not None else ""
-            duration = float(ev["duration_s"]) if ev["duration_s"] is not None else ""
-            trial_type = ev["phase"]
-            w_ev.writerow([
-                onset,
-                duration,
-                trial_type,
-                ev["arm"],
-                ev["base_code"],
-                ev["move_code"],
-                ev["movement_key"],
-                ev["block"],
-                ev["rep"],
-                ev["lsl_marker"],
-                ev["arduino_trigger"],
-            ])
+    # Event rows were streamed during the run; finish the files
+    f_log.close()
+    f_ev.close()
 
     # Write events.json (column metadata)
     events_meta = {
@@ -887,14 +1133,10 @@ def main():
         json.dump(events_meta, f_ej, indent=4)
 
     # brief on-screen confirmation
-    msg = visual.TextStim(
-        win,
-        text=(
-            f"Run summary saved:\n{log_path}\n\n"
-            f"Events TSV/JSON saved in:\n{sub_dir}\n\n"
-            "Press any key to exit."
-        ),
-        color="white", height=0.035
+    msg.text = (
+        f"Run summary saved ({n_events} events):\n{log_path}\n\n"
+        f"Events TSV/JSON saved in:\n{sub_dir}\n\n"
+        "Press any key to exit."
     )
     msg.draw()
     win.flip()
@@ -902,9 +1144,10 @@ def main():
 
     # End
     endt.draw()
+    queue_marker(win, outlet, 8899)
     win.flip()
-    outlet.push_sample([8899])
     core.wait(2)
+    release_movies()
     win.close()
     core.quit()
 
@@ -1,9 +1,8 @@
 import os
 import json
+from pathlib import Path
 import numpy as np
 import pyxdf
-import mne
-from mne.export import export_raw
 
 # ========= USER PARAMETERS (adapt these) =========
 XDF_PATH = r"/Users/elodiedong/Desktop/kraken_data/s011/sub-P005_ses-S011_task-Default_run-001_emg_kraken.xdf"
@@ -14,109 +13,241 @@ SESSION = "S011"   # or "012"
 TASK = "Default"
 RUN = "01"
 LINE_FREQ = 50.0   # or 50 in europe 
+VERBOSE = False    # True: list every stream found in the XDF
 # =================================================
 
-print(f"Loading XDF: {XDF_PATH}")
-streams, file_header = pyxdf.load_xdf(XDF_PATH)
-
-print("\n=== Streams found in file ===")
-for i, s in enumerate(streams):
-    name = s["info"]["name"][0]
-    stype = s["info"]["type"][0] if s["info"]["type"] else ""
-    n_ch = int(s["info"]["channel_count"][0])
-    print(f"{i}: name='{name}', type='{stype}', channels={n_ch}")
-
-# ---- Find EMG stream (by name containing 'EMG') ----
-def find_stream(name_part):
-    for s in streams:
-        if name_part.lower() in s["info"]["name"][0].lower():
-            return s
-    return None
-
-emg_stream = find_stream("EMG")
-if emg_stream is None:
-    raise RuntimeError("Could not find a stream with 'EMG' in its name!")
-
-emg_name = emg_stream["info"]["name"][0]
-
-# --- Robust sampling frequency extraction ---
-info_dict = emg_stream["info"]
-
-def _unpack(val):
-    """Handle values that can be scalar, list, tuple, or numpy array."""
-    import numpy as np
-    if isinstance(val, (list, tuple)):
-        return val[0] if len(val) > 0 else None
-    if isinstance(val, np.ndarray):
-        return val[0] if val.size > 0 else None
-    return val
-
-def _has_value(val):
-    """Return True if val is non-empty / non-null."""
-    import numpy as np
-    if val is None:
-        return False
-    if isinstance(val, (list, tuple)):
-        return len(val) > 0 and val[0] not in ("", None)
-    if isinstance(val, np.ndarray):
-        return val.size > 0
-    if isinstance(val, str):
-        return val != ""
-    return True  # numbers etc.
-
-sfreq_field = info_dict.get("effective_srate", None)
-
-if _has_value(sfreq_field):
-    sfreq_raw = _unpack(sfreq_field)
-else:
-    sfreq_raw = _unpack(info_dict.get("nominal_srate", None))
+# ---- JSON writer: orjson (C encoder) if installed, else the json module ----
+# Outputs are written to <path>.tmp and moved into place with os.replace, so
+# a failed run never leaves a truncated file behind.
+try:
+    import orjson
 
-if sfreq_raw is None:
-    raise RuntimeError("Could not determine sampling frequency from XDF (no effective_srate or nominal_srate).")
+    def dump_json(obj, path):
+        with open(f"{path}.tmp", "wb") as f:
+            f.write(orjson.dumps(obj, option=orjson.OPT_INDENT_2))
+        os.replace(f"{path}.tmp", path)
+except ImportError:
+    def dump_json(obj, path):
+        with open(f"{path}.tmp", "w") as f:
+            json.dump(obj, f, indent=4)
+        os.replace(f"{path}.tmp", path)
 
-sfreq = float(sfreq_raw)
-print(f"Detected sampling frequency: {sfreq} Hz")
 
-data = np.asarray(emg_stream["time_series"])  # shape (n_samples, n_channels)
+# ---- Helper for pyxdf header values ----
+def _first_float(val):
+    """
+    Header value as a float: scalars as-is, lists/tuples/arrays by their
+    first element. None for missing or empty values.
+    """
+    if isinstance(val, (list, tuple, np.ndarray)):
+        if len(val) == 0:
+            return None
+        val = val[0]
+    if val is None or val == "":
+        return None
+    return float(val)
 
-data = data.T  # -> (n_channels, n_samples)
 
-n_channels, n_samples = data.shape
-print(f"\n✅ Using EMG stream '{emg_name}' with {n_channels} channels @ {sfreq} Hz")
-print(f"   Data shape: {data.shape} (n_channels, n_samples)")
+def load_emg_from_xdf(xdf_path, data_path):
+    """
+    Parse the EMG stream of an XDF file.
+    Returns (stream_name, sfreq, data, ch_names); data is a C-ordered
+    (n_channels, n_samples) float32 memmap backed by the .npy file `data_path`.
+    """
+    # Headers-only pass: list the streams without decoding any samples
+    print(f"Reading stream headers: {xdf_path}")
+    stream_headers = pyxdf.resolve_streams(xdf_path)
+
+    if VERBOSE:
+        print("\n=== Streams found in file ===")
+        for i, h in enumerate(stream_headers):
+            print(f"{i}: name='{h['name']}', type='{h['type'] or ''}', channels={h['channel_count']}")
+
+    # ---- Find EMG stream (by name containing 'EMG') ----
+    # headers indexed once by lower-cased name (first stream wins on a clash)
+    by_name = {}
+    for h in stream_headers:
+        by_name.setdefault((h["name"] or "").lower(), h)
+
+    def find_stream(name_part):
+        name_part = name_part.lower()
+        if name_part in by_name:
+            return by_name[name_part]
+        return next((h for name, h in by_name.items() if name_part in name), None)
+
+    emg_header = find_stream("EMG")
+    if emg_header is None:
+        raise RuntimeError("Could not find a stream with 'EMG' in its name!")
+
+    # Decode only the EMG stream; other streams' chunks are skipped
+    print(f"Loading EMG stream from XDF: {xdf_path}")
+    streams, file_header = pyxdf.load_xdf(
+        xdf_path, select_streams=[emg_header["stream_id"]]
+    )
+    emg_stream = streams[0]
+
+    emg_name = emg_stream["info"]["name"][0]
+
+    # --- Robust sampling frequency extraction ---
+    info_dict = emg_stream["info"]
+
+    sfreq = (_first_float(info_dict.get("effective_srate"))
+             or _first_float(info_dict.get("nominal_srate")))
+
+    if not sfreq:
+        raise RuntimeError("Could not determine sampling frequency from XDF (no effective_srate or nominal_srate).")
+
+    print(f"Detected sampling frequency: {sfreq} Hz")
+
+    src = np.asarray(emg_stream["time_series"])  # shape (n_samples, n_channels)
+
+    # Relayout once into a C-ordered (n_channels, n_samples) buffer on disk,
+    # a plain .npy that the cache reopens as a memmap with this exact layout
+    # (write_brainvision then reads it back per block of samples).
+    # One channel at a time, so pages of the output can be written back and
+    # evicted by the OS instead of holding a second full copy in RAM.
+    # Samples are stored as float32 (pyxdf gives float64 for double streams),
+    # cast per channel during the copy.
+    data = np.lib.format.open_memmap(
+        data_path, mode="w+", dtype=np.float32, shape=(src.shape[1], src.shape[0])
+    )
+    for ch in range(data.shape[0]):
+        data[ch] = src[:, ch]
+    data.flush()
+    del src
 
-# ---- Create MNE Raw object (channels marked as EMG) ----
-ch_names = []
-for ch in range(n_channels):
     # if channel labels exist in XDF, use them; otherwise EMG1, EMG2, ...
-    try:
-        ch_label = emg_stream["info"]["desc"][0]["channels"][0]["channel"][ch]["label"][0]
-    except Exception:
-        ch_label = f"EMG{ch+1}"
-    ch_names.append(ch_label)
+    desc = (info_dict.get("desc") or [None])[0] or {}
+    channels = (desc.get("channels") or [None])[0] or {}
+    chans = channels.get("channel") or []
+    n_channels = data.shape[0]
+    if not chans:
+        # no channel metadata (usual for the EMG bridge): default names only
+        ch_names = [f"EMG{ch+1}" for ch in range(n_channels)]
+    else:
+        ch_names = [
+            ((chans[ch].get("label") or [None])[0] if ch < len(chans) else None)
+            or f"EMG{ch+1}"
+            for ch in range(n_channels)
+        ]
+
+    return emg_name, sfreq, data, ch_names
+
+
+def write_brainvision(vhdr_path, data, sfreq, ch_names, block=65536):
+    """
+    Write (n_channels, n_samples) `data` as a BrainVision recording:
+    <base>.vhdr / .vmrk text files and a multiplexed IEEE float32 <base>.eeg.
+    Values are stored unscaled with unit V (what MNE assumes for Raw data).
+    The three files are written as .tmp and renamed once all are complete.
+    """
+    base = os.path.splitext(vhdr_path)[0]
+    eeg_name = os.path.basename(base) + ".eeg"
+    vmrk_name = os.path.basename(base) + ".vmrk"
+    paths = [base + ".eeg", vhdr_path, base + ".vmrk"]
+
+    # MULTIPLEXED = sample-interleaved, i.e. data.T in C order; written in
+    # blocks of samples so no full transposed copy is made
+    n_samples = data.shape[1]
+    with open(base + ".eeg.tmp", "wb") as f:
+        for start in range(0, n_samples, block):
+            seg = data[:, start:start + block].T
+            np.ascontiguousarray(seg, dtype="<f4").tofile(f)
+
+    # commas in channel names are escaped as \1 in BrainVision headers
+    labels = [name.replace(",", "\\1") for name in ch_names]
+    ch_lines = "\n".join(
+        f"Ch{i}={label},,1,V" for i, label in enumerate(labels, 1)
+    )
+    with open(f"{vhdr_path}.tmp", "w", encoding="utf-8") as f:
+        f.write(
+            "Brain Vision Data Exchange Header File Version 1.0\n"
+            "; Data created by xdf_to_bids.py\n\n"
+            "[Common Infos]\n"
+            "Codepage=UTF-8\n"
+            f"DataFile={eeg_name}\n"
+            f"MarkerFile={vmrk_name}\n"
+            "DataFormat=BINARY\n"
+            "DataOrientation=MULTIPLEXED\n"
+            f"NumberOfChannels={len(ch_names)}\n"
+            "; Sampling interval in microseconds\n"
+            f"SamplingInterval={1e6 / sfreq}\n\n"
+            "[Binary Infos]\n"
+            "BinaryFormat=IEEE_FLOAT_32\n\n"
+            "[Channel Infos]\n"
+            "; Ch<n>=<Name>,<Reference channel name>,<Resolution in Unit>,<Unit>\n"
+            f"{ch_lines}\n"
+        )
+    with open(base + ".vmrk.tmp", "w", encoding="utf-8") as f:
+        f.write(
+            "Brain Vision Data Exchange Marker File, Version 1.0\n\n"
+            "[Common Infos]\n"
+            "Codepage=UTF-8\n"
+            f"DataFile={eeg_name}\n\n"
+            "[Marker Infos]\n"
+            "; Mk<n>=<Type>,<Description>,<Position>,<Size>,<Channel number>\n"
+            "Mk1=New Segment,,1,1,0\n"
+        )
+
+    for path in paths:
+        os.replace(f"{path}.tmp", path)
 
-ch_types = ["emg"] * n_channels
-info = mne.create_info(ch_names=ch_names, sfreq=sfreq, ch_types=ch_types)
-info["line_freq"] = LINE_FREQ
 
-raw = mne.io.RawArray(data, info)
+# ---- Parsed-data cache next to the XDF, keyed by its mtime + size ----
+# A rerun on an unchanged file (e.g. to tweak BIDS metadata) skips pyxdf.
+CACHE_DATA_PATH = XDF_PATH + ".cache.npy"
+CACHE_META_PATH = XDF_PATH + ".cache.json"
+xdf_key = [os.path.getmtime(XDF_PATH), os.path.getsize(XDF_PATH)]
+
+cache_meta = None
+if os.path.exists(CACHE_META_PATH) and os.path.exists(CACHE_DATA_PATH):
+    with open(CACHE_META_PATH) as f:
+        cache_meta = json.load(f)
+    if cache_meta.get("key") != xdf_key:
+        cache_meta = None
+
+if cache_meta is not None:
+    print(f"Using cached EMG data: {CACHE_DATA_PATH}")
+    data = np.load(CACHE_DATA_PATH, mmap_mode="r")
+    emg_name = cache_meta["stream_name"]
+    sfreq = cache_meta["sfreq"]
+    ch_names = cache_meta["ch_names"]
+else:
+    # the relayout is written straight into the (temporary) cache file, which
+    # is moved into place only once complete, then reopened read-only
+    emg_name, sfreq, data, ch_names = load_emg_from_xdf(
+        XDF_PATH, CACHE_DATA_PATH + ".tmp"
+    )
+    del data  # close the memmap before renaming (required on Windows)
+    os.replace(CACHE_DATA_PATH + ".tmp", CACHE_DATA_PATH)
+    data = np.load(CACHE_DATA_PATH, mmap_mode="r")
+    dump_json({"key": xdf_key, "stream_name": emg_name,
+               "sfreq": sfreq, "ch_names": ch_names}, CACHE_META_PATH)
+
+n_channels, n_samples = data.shape
+# channel-major C layout (rows of samples), so each block written to the
+# BrainVision .eeg is a strided view of the memmap, never a reshape copy
+assert data.strides == (n_samples * data.itemsize, data.itemsize)
+print(f"\n✅ Using EMG stream '{emg_name}' with {n_channels} channels @ {sfreq} Hz")
+print(f"   Data shape: {data.shape} (n_channels, n_samples)")
 
 # ---- BIDS paths ----
 sub = f"sub-{SUBJECT}"
 ses = f"ses-{SESSION}"
 
-emg_dir = os.path.join(BIDS_ROOT, sub, ses, "emg")
-beh_dir = os.path.join(BIDS_ROOT, sub, ses, "beh")
-os.makedirs(emg_dir, exist_ok=True)
-os.makedirs(beh_dir, exist_ok=True)
+bids_root = Path(BIDS_ROOT)
+ses_dir = bids_root / sub / ses
+emg_dir = ses_dir / "emg"
+beh_dir = ses_dir / "beh"
+emg_dir.mkdir(parents=True, exist_ok=True)
+beh_dir.mkdir(parents=True, exist_ok=True)
 
 bids_basename = f"sub-{SUBJECT}_ses-{SESSION}_task-{TASK}_run-{RUN}"
 
-bv_fname = bids_basename + "_emg.vhdr"
-bv_path = os.path.join(emg_dir, bv_fname)
+bv_path = emg_dir / f"{bids_basename}_emg.vhdr"
 
 print(f"\n💾 Writing EMG to BrainVision: {bv_path}")
-export_raw(bv_path, raw, fmt="brainvision", overwrite=True)
+write_brainvision(bv_path, data, sfreq, ch_names)
 
 
 # ---- Sidecar JSON for EMG ----
@@ -134,14 +265,13 @@ emg_json = {
     "Reference": "unknown",
 }
 
-emg_json_path = os.path.join(emg_dir, bids_basename + "_emg.json")
+emg_json_path = emg_dir / f"{bids_basename}_emg.json"
 print(f"💾 Writing EMG sidecar JSON: {emg_json_path}")
-with open(emg_json_path, "w") as f:
-    json.dump(emg_json, f, indent=4)
+dump_json(emg_json, emg_json_path)
 
 # ---- Minimal dataset_description.json (if not present) ----
-dataset_description_path = os.path.join(BIDS_ROOT, "dataset_description.json")
-if not os.path.exists(dataset_description_path):
+dataset_description_path = bids_root / "dataset_description.json"
+if not dataset_description_path.exists():
     dataset_description = {
         "Name": "Kraken EMG dataset",
         "BIDSVersion": "1.9.0",
@@ -149,8 +279,7 @@ if not os.path.exists(dataset_description_path):
         "Authors": ["Elodie", "Lab team"],
     }
     print(f"💾 Creating dataset_description.json at {dataset_description_path}")
-    with open(dataset_description_path, "w") as f:
-        json.dump(dataset_description, f, indent=4)
+    dump_json(dataset_description, dataset_description_path)
 else:
     print("dataset_description.json already exists, leaving it unchanged.")
 